@@ -1,24 +1,131 @@
-import base64
+import atexit
 import binascii
-import io
+import gc
 import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional
+from types import MappingProxyType
+from typing import IO, Optional
+from xml.sax.saxutils import escape as xml_escape
 
 from flask import Flask, render_template, request, jsonify, send_file
 from dotenv import load_dotenv
 import requests
-from docx import Document
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from docx.shared import Inches
+from docxtpl import DocxTemplate, InlineImage, Listing
+import orjson
+import pybase64
 
 # .env 파일에서 환경 변수를 로드합니다.
 load_dotenv()
 
 app = Flask(__name__, template_folder='templates')
 
+# DOCX 보고서의 골격(제목, 요약, 그룹 반복 구간)을 담은 docxtpl 템플릿입니다.
+REPORT_TEMPLATE_PATH = os.path.join(app.root_path, 'templates', 'report_template.docx')
+
+# nginx/Apache 같은 리버스 프록시 뒤에서 실행할 때만 USE_X_SENDFILE=1로 켭니다.
+# 켜면 보고서 파일 전송을 프록시가 맡고, 워커는 헤더만 보낸 뒤 바로 해제됩니다.
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "").lower() in {"1", "true", "yes"}
+
 # OpenAI API 키를 환경 변수에서 가져옵니다.
 API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_API_URL = "https://api.openai.com/v1/responses"
+OPENAI_FILES_URL = "https://api.openai.com/v1/files"
+OPENAI_BATCHES_URL = "https://api.openai.com/v1/batches"
+OPENAI_BATCH_ENDPOINT = "/v1/responses"
+# content_parts_list로 한 번에 들어온 분석 요청을 동시에 보낼 최대 개수입니다.
+ANALYZE_MAX_CONCURRENCY = 8
+# 생성된 DOCX 보고서를 저장할 임시 디렉터리와, X-Sendfile 사용 시 파일을 남겨둘 시간(초)입니다.
+REPORT_TEMP_DIR = os.path.join(tempfile.gettempdir(), "analysis_reports")
+REPORT_FILE_TTL = 10 * 60
+os.makedirs(REPORT_TEMP_DIR, exist_ok=True)
+# 이미지 data URL을 나눠 디코딩할 단위(base64 문자 수, 4의 배수)와
+# 디코딩된 이미지를 메모리에 보관할 최대 크기입니다.
+DATA_URL_DECODE_CHUNK_SIZE = 256 * 1024
+IMAGE_SPOOL_MAX_SIZE = 4 * 1024 * 1024
+# 보고서 이미지 디코딩에 쓰는 스레드 수입니다.
+IMAGE_DECODE_WORKERS = os.cpu_count() or 1
+
+# 모델별 생성 파라미터입니다. 지원하지 않는 모델은 DEFAULT_MODEL로 대체됩니다.
+# 요청마다 공유되므로 읽기 전용 매핑으로 고정합니다.
+DEFAULT_MODEL = "gpt-5-mini"
+MODEL_PRESETS = MappingProxyType({
+    "gpt-5-mini": MappingProxyType({
+        "max_output_tokens": 4096,
+        "temperature": 0.2,
+        "top_p": 0.8,
+    }),
+    "gpt-4o": MappingProxyType({
+        "max_output_tokens": 3072,
+        "temperature": 0.6,
+        "top_p": 0.9,
+    }),
+})
+DEFAULT_MODEL_PRESET = MODEL_PRESETS[DEFAULT_MODEL]
+
+# 분석 요청 본문은 orjson으로 직접 직렬화해 보내므로 Content-Type을 명시합니다.
+BASE_HEADERS = MappingProxyType({"Content-Type": "application/json"})
+
+# OpenAI 요청의 (연결, 읽기) 타임아웃(초)입니다.
+OPENAI_TIMEOUT = (5, 120)
+
+# 429/5xx 같은 일시적인 오류는 지수 백오프로 최대 3번 재시도하며 Retry-After를 따릅니다.
+# 마지막 오류 응답은 그대로 돌려받아 raise_for_status()에서 OpenAI 오류 메시지와 함께 처리합니다.
+# 기본 정책은 urllib3 기본값대로 POST를 재시도하지 않습니다. 파일 업로드나 batch 생성처럼
+# 리소스를 만드는 요청은 서버가 이미 처리했을 수 있어 다시 보내면 중복 생성·과금되기 때문입니다.
+OPENAI_RETRY = Retry(
+    total=3,
+    backoff_factor=1.0,
+    status_forcelist=[429, 500, 502, 503, 504],
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+# 분석 요청(/v1/responses)만 POST 재시도를 허용합니다. 읽기 타임아웃은 요청이 이미
+# 처리 중일 수 있어 다시 보내지 않습니다.
+ANALYZE_RETRY = OPENAI_RETRY.new(read=0, allowed_methods=frozenset({"POST"}))
+
+# OpenAI 호출은 하나의 세션을 공유하여 keep-alive 연결(TCP/TLS)을 재사용합니다.
+# requests는 가장 긴 접두사로 어댑터를 고르므로 분석 URL에만 ANALYZE_RETRY가 적용됩니다.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=OPENAI_RETRY,
+))
+SESSION.mount(OPENAI_API_URL, HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=ANALYZE_RETRY,
+))
+if API_KEY:
+    # Content-Type은 요청별로 정해지므로(json=, files=) 세션에는 인증 헤더만 둡니다.
+    SESSION.headers.update({"Authorization": f"Bearer {API_KEY}"})
+atexit.register(SESSION.close)
+
+
+_TEXT_TYPES = frozenset({"text", "input_text"})
+_IMAGE_TYPES = frozenset({"image_url", "input_image"})
+_PASSTHROUGH_TYPES = frozenset({"input_audio", "input_video", "input_file"})
+
+
+def _is_normalized_part(part) -> bool:
+    """Return True if the part is already exactly what normalization would produce."""
+    if not isinstance(part, dict):
+        return False
+    part_type = part.get("type")
+    if part_type == "input_text":
+        return len(part) == 2 and isinstance(part.get("text"), str)
+    if part_type == "input_image":
+        image_url = part.get("image_url")
+        return len(part) == 2 and isinstance(image_url, str) and bool(image_url)
+    return part_type in _PASSTHROUGH_TYPES
 
 
 def _normalize_content_parts(content_parts):
@@ -27,19 +134,23 @@ def _normalize_content_parts(content_parts):
     if not isinstance(content_parts, list):
         return normalized
 
+    # The frontend already sends Responses API parts; skip rebuilding them.
+    if all(_is_normalized_part(part) for part in content_parts):
+        return content_parts
+
     for part in content_parts:
         if not isinstance(part, dict):
             continue
 
         part_type = part.get("type")
 
-        if part_type in {"text", "input_text"}:
+        if part_type in _TEXT_TYPES:
             text_value = part.get("text")
             if isinstance(text_value, str):
                 normalized.append({"type": "input_text", "text": text_value})
             continue
 
-        if part_type in {"image_url", "input_image"}:
+        if part_type in _IMAGE_TYPES:
             image_url = part.get("image_url")
             if isinstance(image_url, dict):
                 url_value = image_url.get("url")
@@ -50,7 +161,7 @@ def _normalize_content_parts(content_parts):
             continue
 
         # Passthrough any already-normalized content blocks.
-        if part_type in {"input_audio", "input_video", "input_file"}:
+        if part_type in _PASSTHROUGH_TYPES:
             normalized.append(part)
 
     if not normalized:
@@ -61,6 +172,24 @@ def _normalize_content_parts(content_parts):
     return normalized
 
 
+def _iter_output_text(response_payload):
+    """Yield each non-empty text chunk from the message items of a Responses API payload."""
+    output_items = response_payload.get("output")
+    if not isinstance(output_items, list):
+        return
+    for item in output_items:
+        if not isinstance(item, dict) or item.get("type") != "message":
+            continue
+        contents = item.get("content") or []
+        if not isinstance(contents, list):
+            continue
+        for content in contents:
+            if isinstance(content, dict):
+                text_value = content.get("text")
+                if isinstance(text_value, str) and text_value:
+                    yield text_value
+
+
 def _extract_text_from_response(response_payload):
     """Pull a best-effort assistant text string from a Responses API payload."""
     if not isinstance(response_payload, dict):
@@ -70,26 +199,9 @@ def _extract_text_from_response(response_payload):
     if isinstance(output_text, str) and output_text.strip():
         return output_text
 
-    collected = []
-    output_items = response_payload.get("output")
-    if isinstance(output_items, list):
-        for item in output_items:
-            if not isinstance(item, dict):
-                continue
-            if item.get("type") != "message":
-                continue
-            contents = item.get("content") or []
-            if not isinstance(contents, list):
-                continue
-            for content in contents:
-                if not isinstance(content, dict):
-                    continue
-                text_value = content.get("text")
-                if isinstance(text_value, str) and text_value:
-                    collected.append(text_value)
-
+    collected = "\n".join(_iter_output_text(response_payload))
     if collected:
-        return "\n".join(collected)
+        return collected
 
     # Fallback: if the upstream response still uses chat-completions layout, read it.
     choices = response_payload.get("choices")
@@ -109,55 +221,107 @@ def index():
     """메인 웹페이지를 렌더링합니다."""
     return render_template('index.html')
 
-@app.route('/analyze', methods=['POST'])
-def analyze():
-    """
-    프론트엔드로부터 요청을 받아 OpenAI API를 호출하고 결과를 반환합니다.
-    """
-    if not API_KEY:
-        print("🛑 오류: .env 파일에 OPENAI_API_KEY가 설정되지 않았습니다.")
-        return jsonify({"error": ".env 파일에 OPENAI_API_KEY가 설정되지 않았습니다."}), 500
-
-    data = request.json
-    
-    content_parts = data.get("content_parts", [])
-    normalized_content = _normalize_content_parts(content_parts)
-
-    # 프론트엔드에서 받은 데이터를 기반으로 OpenAI에 보낼 payload를 구성합니다.
-    requested_model = data.get("model", "gpt-5-mini")
-    model_presets = {
-        "gpt-5-mini": {
-            "max_output_tokens": 4096,
-            "temperature": 0.2,
-            "top_p": 0.8,
-        },
-        "gpt-4o": {
-            "max_output_tokens": 3072,
-            "temperature": 0.6,
-            "top_p": 0.9,
-        },
-    }
-
-    if requested_model not in model_presets:
-        print(f"⚠️ 지원하지 않는 모델이 요청되었습니다: {requested_model}. gpt-5-mini로 대체합니다.")
+def _resolve_model(requested_model):
+    """Return the model name and generation preset to use, falling back to DEFAULT_MODEL."""
+    model_payload_options = MODEL_PRESETS.get(requested_model)
+    if model_payload_options is None:
+        print(f"⚠️ 지원하지 않는 모델이 요청되었습니다: {requested_model}. {DEFAULT_MODEL}로 대체합니다.")
+        return DEFAULT_MODEL, DEFAULT_MODEL_PRESET
+    return requested_model, model_payload_options
 
-    model = requested_model if requested_model in model_presets else "gpt-5-mini"
-    model_payload_options = model_presets[model]
 
-    payload = {
+def _model_payload(content_parts, model, model_payload_options):
+    """Build a Responses API request body for already-resolved model settings."""
+    return {
         # gpt-5-mini는 텍스트와 이미지 URL이 혼합된 메시지를 처리할 수 있는 멀티모달 모델입니다.
         "model": model,
         "input": [{
             "role": "user",
-            "content": normalized_content,
+            "content": _normalize_content_parts(content_parts),
         }],
         **model_payload_options,
     }
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}",
-    }
+
+def _build_model_payload(content_parts, requested_model):
+    """Build a Responses API request body for the given content parts and model."""
+    model, model_payload_options = _resolve_model(requested_model)
+    return model, model_payload_options, _model_payload(content_parts, model, model_payload_options)
+
+
+def _openai_error_message(error: requests.exceptions.RequestException) -> str:
+    """Pull the most useful error message out of a failed OpenAI API call."""
+    error_message = str(error)
+    if error.response is not None:
+        try:
+            error_detail = error.response.json()
+            error_message = error_detail.get("error", {}).get("message", "알 수 없는 오류")
+        except ValueError:
+            error_message = error.response.text
+    return error_message
+
+
+def _missing_api_key_response():
+    print("🛑 오류: .env 파일에 OPENAI_API_KEY가 설정되지 않았습니다.")
+    return jsonify({"error": ".env 파일에 OPENAI_API_KEY가 설정되지 않았습니다."}), 500
+
+
+def _request_analysis(payload):
+    """Send one Responses API request and return the decoded JSON payload."""
+    response = SESSION.post(
+        OPENAI_API_URL,
+        data=orjson.dumps(payload),
+        headers=BASE_HEADERS,
+        timeout=OPENAI_TIMEOUT,
+    )
+    response.raise_for_status()  # HTTP 오류가 발생하면 예외를 발생시킵니다.
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as decode_error:
+        raise requests.exceptions.InvalidJSONError(str(decode_error), response=response) from decode_error
+
+
+def _analyze_one(index, payload):
+    """Run a single analysis for the multi-prompt path, capturing failures per item."""
+    try:
+        response_payload = _request_analysis(payload)
+    except requests.exceptions.RequestException as e:
+        error_message = _openai_error_message(e)
+        print(f"🛑 OpenAI API 호출 실패 (항목 {index}): {error_message}")
+        return {"index": index, "error": f"OpenAI API 호출 실패: {error_message}"}
+    return {"index": index, "content": _extract_text_from_response(response_payload)}
+
+
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    """
+    프론트엔드로부터 요청을 받아 OpenAI API를 호출하고 결과를 반환합니다.
+    content_parts_list가 전달되면 각 항목을 독립된 요청으로 동시에 보내고
+    항목 순서대로 정렬된 results 목록을 반환합니다.
+    """
+    if not API_KEY:
+        return _missing_api_key_response()
+
+    data = request.json
+    requested_model = data.get("model", DEFAULT_MODEL)
+
+    content_parts_list = data.get("content_parts_list")
+    if isinstance(content_parts_list, list) and content_parts_list:
+        model, model_payload_options = _resolve_model(requested_model)
+        payloads = [
+            _model_payload(content_parts, model, model_payload_options)
+            for content_parts in content_parts_list
+        ]
+        print(f"🚀 OpenAI API에 {len(payloads)}건의 분석을 동시에 요청합니다...")
+        max_workers = min(len(payloads), ANALYZE_MAX_CONCURRENCY)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_analyze_one, range(len(payloads)), payloads))
+        print("✅ OpenAI API로부터 모든 응답을 받았습니다.")
+        return jsonify({"results": results})
+
+    # 프론트엔드에서 받은 데이터를 기반으로 OpenAI에 보낼 payload를 구성합니다.
+    content_parts = data.get("content_parts", [])
+    model, model_payload_options, payload = _build_model_payload(content_parts, requested_model)
 
     try:
         print(
@@ -165,10 +329,8 @@ def analyze():
             f"(model={model}, temperature={model_payload_options['temperature']}, "
             f"max_output_tokens={model_payload_options['max_output_tokens']}, top_p={model_payload_options['top_p']})"
         )
-        response = requests.post(OPENAI_API_URL, headers=headers, json=payload)
-        response.raise_for_status()  # HTTP 오류가 발생하면 예외를 발생시킵니다.
+        response_payload = _request_analysis(payload)
         print("✅ OpenAI API로부터 응답을 받았습니다.")
-        response_payload = response.json()
         analysis_text = _extract_text_from_response(response_payload)
         return jsonify({
             "choices": [{"message": {"content": analysis_text}}],
@@ -177,40 +339,240 @@ def analyze():
         
     except requests.exceptions.RequestException as e:
         # API 호출 실패 시 에러 메시지를 JSON 형식으로 반환합니다.
-        error_message = str(e)
-        if e.response:
-            try:
-                error_detail = e.response.json()
-                error_message = error_detail.get("error", {}).get("message", "알 수 없는 오류")
-            except ValueError:
-                error_message = e.response.text
-        
+        error_message = _openai_error_message(e)
         print(f"🛑 OpenAI API 호출 실패: {error_message}")
         return jsonify({"error": f"OpenAI API 호출 실패: {error_message}"}), 500
 
 
-def _decode_data_url(data_url: Optional[str]) -> Optional[bytes]:
-    """Decode a base64 data URL into raw bytes."""
-    if not data_url or not data_url.startswith("data:"):
+@app.route('/analyze-batch', methods=['POST'])
+def analyze_batch():
+    """
+    여러 분석 요청을 OpenAI Batch API 작업으로 제출하고 batch id를 반환합니다.
+    결과는 /analyze-batch/<batch_id>로 조회합니다.
+    """
+    if not API_KEY:
+        return _missing_api_key_response()
+
+    data = request.get_json(silent=True) or {}
+    items = data.get("items")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items에 분석할 content_parts 목록을 전달해주세요."}), 400
+
+    model, model_payload_options = _resolve_model(data.get("model", DEFAULT_MODEL))
+    lines = []
+    for index, content_parts in enumerate(items):
+        lines.append(orjson.dumps({
+            "custom_id": str(index),
+            "method": "POST",
+            "url": OPENAI_BATCH_ENDPOINT,
+            "body": _model_payload(content_parts, model, model_payload_options),
+        }))
+    batch_input = b"\n".join(lines) + b"\n"
+
+    try:
+        print(f"🚀 OpenAI Batch API에 {len(items)}건의 분석을 제출합니다...")
+        upload_response = SESSION.post(
+            OPENAI_FILES_URL,
+            data={"purpose": "batch"},
+            files={"file": ("analyze_batch.jsonl", batch_input, "application/jsonl")},
+            timeout=OPENAI_TIMEOUT,
+        )
+        upload_response.raise_for_status()
+        input_file_id = upload_response.json().get("id")
+        if not input_file_id:
+            print("🛑 OpenAI Batch 제출 실패: 업로드 응답에 파일 id가 없습니다.")
+            return jsonify({"error": "OpenAI Batch 제출 실패: 업로드 응답에 파일 id가 없습니다."}), 500
+
+        batch_response = SESSION.post(
+            OPENAI_BATCHES_URL,
+            json={
+                "input_file_id": input_file_id,
+                "endpoint": OPENAI_BATCH_ENDPOINT,
+                "completion_window": "24h",
+            },
+            timeout=OPENAI_TIMEOUT,
+        )
+        batch_response.raise_for_status()
+        batch = batch_response.json()
+        print(f"✅ Batch 작업이 생성되었습니다: {batch.get('id')}")
+        return jsonify({
+            "batch_id": batch.get("id"),
+            "status": batch.get("status"),
+            "item_count": len(items),
+        })
+
+    except requests.exceptions.RequestException as e:
+        error_message = _openai_error_message(e)
+        print(f"🛑 OpenAI Batch 제출 실패: {error_message}")
+        return jsonify({"error": f"OpenAI Batch 제출 실패: {error_message}"}), 500
+
+
+_BATCH_ID_RE = re.compile(r"batch_[A-Za-z0-9]+")
+
+
+def _parse_batch_output(output_text: str, results: dict) -> None:
+    """Collect per-item results from a Batch API output/error JSONL file, keyed by custom_id."""
+    for line in output_text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = orjson.loads(line)
+            index = int(record.get("custom_id"))
+        except (ValueError, TypeError, AttributeError):
+            continue
+
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            error = record.get("error") or body.get("error") or {}
+            results[index] = {"index": index, "error": error.get("message", "알 수 없는 오류")}
+        else:
+            results[index] = {"index": index, "content": _extract_text_from_response(body)}
+
+
+@app.route('/analyze-batch/<batch_id>', methods=['GET'])
+def analyze_batch_status(batch_id):
+    """
+    Batch 작업 상태를 조회하고, 완료된 경우 항목별 분석 결과를 반환합니다.
+    """
+    if not API_KEY:
+        return _missing_api_key_response()
+
+    # 사용자가 보낸 경로 값이 인증된 OpenAI URL에 그대로 들어가므로 형식을 확인합니다.
+    if not _BATCH_ID_RE.fullmatch(batch_id):
+        return jsonify({"error": "유효하지 않은 batch id입니다."}), 400
+
+    try:
+        batch_response = SESSION.get(f"{OPENAI_BATCHES_URL}/{batch_id}", timeout=OPENAI_TIMEOUT)
+        batch_response.raise_for_status()
+        batch = batch_response.json()
+        status = batch.get("status")
+        result = {
+            "batch_id": batch_id,
+            "status": status,
+            "request_counts": batch.get("request_counts"),
+        }
+        if status != "completed":
+            return jsonify(result)
+
+        # 성공한 요청은 output 파일에, 실패한 요청은 error 파일에 기록됩니다.
+        results = {}
+        for file_key in ("output_file_id", "error_file_id"):
+            file_id = batch.get(file_key)
+            if not file_id:
+                continue
+            file_response = SESSION.get(f"{OPENAI_FILES_URL}/{file_id}/content", timeout=OPENAI_TIMEOUT)
+            file_response.raise_for_status()
+            _parse_batch_output(file_response.text, results)
+
+        result["results"] = [results[index] for index in sorted(results)]
+        return jsonify(result)
+
+    except requests.exceptions.RequestException as e:
+        error_message = _openai_error_message(e)
+        print(f"🛑 OpenAI Batch 조회 실패: {error_message}")
+        return jsonify({"error": f"OpenAI Batch 조회 실패: {error_message}"}), 500
+
+
+_DATA_URL_HEADER_RE = re.compile(r"data:[^,]{0,256};base64,")
+
+
+def _decode_data_url(data_url: Optional[str]) -> Optional[IO[bytes]]:
+    """Decode a base64 data URL into a file-like object positioned at the start."""
+    if not data_url:
+        return None
+    # The header is matched against a bounded prefix, so the (possibly multi-MB)
+    # payload is never scanned or split into a second string.
+    header = _DATA_URL_HEADER_RE.match(data_url)
+    if header is None:
         return None
     try:
-        header, encoded = data_url.split(",", 1)
+        # One ASCII copy is needed for decoding anyway; slice it through a
+        # memoryview instead of copying the payload again.
+        encoded = memoryview(data_url.encode("ascii"))[header.end():]
     except ValueError:
         return None
-    if ";base64" not in header:
-        return None
+
+    output = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_MAX_SIZE)
     try:
-        return base64.b64decode(encoded)
+        # Decode in 4-character-aligned chunks so only one chunk of output is
+        # held in memory at a time.
+        for offset in range(0, len(encoded), DATA_URL_DECODE_CHUNK_SIZE):
+            output.write(pybase64.b64decode(encoded[offset:offset + DATA_URL_DECODE_CHUNK_SIZE], validate=True))
     except (binascii.Error, ValueError):
+        # Whitespace or stray characters break chunk alignment; fall back to a
+        # single lenient decode like before.
+        output.seek(0)
+        output.truncate()
+        try:
+            output.write(pybase64.b64decode(encoded, validate=False))
+        except (binascii.Error, ValueError):
+            output.close()
+            return None
+
+    if not output.tell():
+        output.close()
         return None
+    output.seek(0)
+    return output
+
+
+# \w matches exactly the characters for which str.isalnum() is true, plus "_".
+_UNSAFE_FILENAME_CHARS_RE = re.compile(r"[^\w \-]")
 
 
 def _sanitize_filename(filename: str) -> str:
     base_name = filename.rsplit('.', 1)[0]
-    safe = ''.join(ch for ch in base_name if ch.isalnum() or ch in (' ', '_', '-')).strip()
+    safe = _UNSAFE_FILENAME_CHARS_RE.sub('', base_name).strip()
     return safe or "analysis_report"
 
 
+def _create_image_decode_executor():
+    """Create the shared image-decode pool, using native threads even under gevent."""
+    gevent_monkey = sys.modules.get("gevent.monkey")
+    if gevent_monkey is not None and gevent_monkey.is_module_patched("threading"):
+        # After monkey.patch_all() a stdlib ThreadPoolExecutor runs greenlets on one OS
+        # thread, so decodes would run one after another. gevent's executor uses real
+        # threads and its futures wait cooperatively.
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor(max_workers=IMAGE_DECODE_WORKERS)
+    return ThreadPoolExecutor(max_workers=IMAGE_DECODE_WORKERS, thread_name_prefix="image-decode")
+
+
+IMAGE_DECODE_EXECUTOR = _create_image_decode_executor()
+
+
+class _ReportImage(InlineImage):
+    """InlineImage that renders a failure note instead of aborting the whole report."""
+
+    def _insert_image(self):
+        # python-docx parses the image only here, during render; catching per image
+        # avoids reading and parsing every blob a second time just to validate it.
+        try:
+            return super()._insert_image()
+        except Exception as picture_error:  # pylint: disable=broad-except
+            return xml_escape(f"[이미지 추가 실패: {picture_error}]")
+
+
+def _remove_report(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError as remove_error:
+        print(f"⚠️ 보고서 임시 파일 삭제 실패: {remove_error}")
+
+
+def _remove_stale_reports() -> None:
+    """Delete report files older than REPORT_FILE_TTL (left for X-Sendfile or by failed requests)."""
+    cutoff = time.time() - REPORT_FILE_TTL
+    with os.scandir(REPORT_TEMP_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+
 @app.route('/create-report', methods=['POST'])
 def create_report():
     if not request.is_json:
@@ -223,18 +585,22 @@ def create_report():
     if not isinstance(analysis_results, list):
         analysis_results = []
 
-    document = Document()
+    image_urls = [
+        (result.get("images") if isinstance(result, dict) else []) or []
+        for result in analysis_results
+    ]
 
-    document.add_heading(title.replace('.pdf', ''), level=0)
-    document.add_paragraph(f"생성일: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    _remove_stale_reports()
 
-    document.add_page_break()
-    document.add_heading("Executive Summary", level=1)
-    for line in str(global_summary).split('\n'):
-        document.add_paragraph(line)
+    tpl = DocxTemplate(REPORT_TEMPLATE_PATH)
+    image_streams = []
+    groups = []
 
-    document.add_page_break()
-    document.add_heading("상세 분석 (Detailed Analysis)", level=1)
+    # 이미지는 공용 스레드 풀에서 병렬로 디코딩합니다.
+    decoded_images = [
+        [IMAGE_DECODE_EXECUTOR.submit(_decode_data_url, image_data_url) for image_data_url in urls]
+        for urls in image_urls
+    ]
 
     for index, result in enumerate(analysis_results, start=1):
         group = result.get("group") if isinstance(result, dict) else {}
@@ -243,45 +609,71 @@ def create_report():
         group_id = group.get("id", index)
         pages = group.get("pages") or []
         pages_text = ", ".join(str(page) for page in pages) if pages else "N/A"
-        document.add_heading(f"그룹 {group_id} (페이지: {pages_text})", level=2)
-
-        intent = group.get("intent", "")
-        intent_paragraph = document.add_paragraph()
-        intent_run = intent_paragraph.add_run("분석 초점: ")
-        intent_run.bold = True
-        intent_paragraph.add_run(str(intent))
-
-        images = result.get("images") if isinstance(result, dict) else []
-        for image_data_url in images or []:
-            image_bytes = _decode_data_url(image_data_url)
-            if not image_bytes:
+
+        images = []
+        for image_future in decoded_images[index - 1]:
+            image_stream = image_future.result()
+            if image_stream is None:
                 continue
-            image_stream = io.BytesIO(image_bytes)
-            try:
-                document.add_picture(image_stream, width=Inches(6))
-            except Exception as picture_error:  # pylint: disable=broad-except
-                document.add_paragraph(f"[이미지 추가 실패: {picture_error}]")
+            image_streams.append(image_stream)
+            images.append(_ReportImage(tpl, image_stream, width=Inches(6)))
 
         analysis_text = result.get("analysis", "") if isinstance(result, dict) else ""
-        for line in str(analysis_text).split('\n'):
-            document.add_paragraph(line)
-
-        document.add_paragraph()
+        groups.append({
+            "heading": f"그룹 {group_id} (페이지: {pages_text})",
+            "intent": str(group.get("intent", "")),
+            "images": images,
+            "analysis": Listing(str(analysis_text)),
+        })
 
-    buffer = io.BytesIO()
-    document.save(buffer)
-    buffer.seek(0)
+    # 템플릿(templates/report_template.docx)을 한 번에 렌더링해 문서를 만듭니다.
+    try:
+        tpl.render({
+            "title": title.replace('.pdf', ''),
+            "created_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "global_summary": Listing(str(global_summary)),
+            "groups": groups,
+        }, autoescape=True)
+
+        # 보고서는 디스크 임시 파일에 저장하고 경로로 전송합니다.
+        with tempfile.NamedTemporaryFile(suffix=".docx", dir=REPORT_TEMP_DIR, delete=False) as report_file:
+            report_path = report_file.name
+            tpl.save(report_file)
+    finally:
+        for image_stream in image_streams:
+            image_stream.close()
+
+    # python-docx/lxml 트리는 순환 참조를 가지므로 즉시 해제되도록 수거합니다.
+    del tpl, groups
+    gc.collect()
 
     filename = f"{_sanitize_filename(str(title))}_analysis_report.docx"
 
-    return send_file(
-        buffer,
+    response = send_file(
+        report_path,
         as_attachment=True,
         download_name=filename,
         mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        conditional=True,
     )
 
+    if app.config["USE_X_SENDFILE"]:
+        # 프록시가 응답 이후에 파일을 읽으므로 바로 지우지 않습니다.
+        # 남은 파일은 이후 요청에서 _remove_stale_reports가 정리합니다.
+        return response
+
+    def _release_report():
+        # 응답 전송이 끝난 뒤 임시 파일을 지우고, 요청 처리 중 생긴 순환 참조를 한 번 더 수거합니다.
+        _remove_report(report_path)
+        gc.collect()
+
+    # send_file 응답은 direct_passthrough라서 call_on_close 콜백이 실행되지 않습니다.
+    # 일반 응답처럼 닫히도록 해서 파일을 닫은 뒤 _release_report가 호출되게 합니다.
+    response.direct_passthrough = False
+    response.call_on_close(_release_report)
+    return response
+
 if __name__ == '__main__':
     port = 5001
     print(f"✅ 서버를 시작합니다. http://127.0.0.1:{port} 에서 접속하세요.")
-    app.run(debug=True, port=port)
+    app.run(debug=True, port=port, threaded=True)
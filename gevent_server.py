@@ -0,0 +1,13 @@
+# gevent 몽키 패치는 다른 모듈(socket, ssl, requests 등)을 import하기 전에 적용해야 합니다.
+from gevent import monkey
+
+monkey.patch_all()
+
+from gevent.pywsgi import WSGIServer  # noqa: E402
+
+from app import app  # noqa: E402
+
+if __name__ == '__main__':
+    port = 5001
+    print(f"✅ gevent 서버를 시작합니다. http://127.0.0.1:{port} 에서 접속하세요.")
+    WSGIServer(('127.0.0.1', port), app).serve_forever()
@@ -4,7 +4,7 @@ cd /d C:\analyzer
 
 echo Starting the analysis server in C:\analyzer...
 REM --- 파이썬 웹 서버를 실행합니다 ---
-python app.py
+python gevent_server.py
 
 echo Starting web browser...
 REM --- 웹 브라우저를 열어 분석기 페이지에 접속합니다 ---